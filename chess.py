@@ -1,4 +1,6 @@
 import asyncio
+import base64
+import hashlib
 import json
 import logging
 import os
@@ -7,7 +9,9 @@ import subprocess
 import time
 import ipaddress
 import re
+import struct
 from concurrent.futures import ProcessPoolExecutor
+from uci_capture import CaptureWriter, CLIENT_INPUT, ENGINE_INPUT, ENGINE_OUTPUT, SPECULATIVE_INPUT, SPECULATIVE_OUTPUT, CACHE_ANSWER
 
 # Load configurations from config.json
 with open("config.json") as f:
@@ -22,21 +26,51 @@ MAX_CONNECTIONS = config["max_connections"]
 connection_attempts = {}
 # Dictionary to store connection attempts for subnets
 subnet_connection_attempts = {}
+# Dictionary to store shared analyses of the JSON/WebSocket API, keyed by engine, position and limits
+analysis_sessions = {}
+
+# GUID used to compute Sec-WebSocket-Accept (RFC 6455)
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_MAX_MESSAGE_SIZE = 65536
+# Clients that let this much unsent data pile up are disconnected instead of slowing down other subscribers
+WEBSOCKET_MAX_BUFFERED = 1048576
+# Numeric "info" fields forwarded to JSON clients
+UCI_INFO_FIELDS = {"depth", "seldepth", "multipv", "nodes", "nps", "time", "hashfull", "tbhits"}
+# Binary capture of client/engine traffic, created in main() when enable_uci_capture is set
+uci_capture = None
+# Results of speculative analysis, keyed by engine name, the session's setoption values and "position ..." command
+speculation_cache = {}
 
-# Configure logging
-if config["enable_server_log"]:
-    server_log_file = os.path.join(BASE_LOG_DIR, "server.log")
-    try:
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s [%(levelname)s] %(message)s",
-            handlers=[
-                logging.FileHandler(server_log_file),
-                logging.StreamHandler()
-            ]
-        )
-    except Exception as e:
-        print(f"Error configuring logging: {e}")
+sem = asyncio.Semaphore(MAX_CONNECTIONS)
+# Every read-modify-write of the Chess-Block-* firewall rules holds this lock, so concurrent updates are not lost
+firewall_lock = asyncio.Lock()
+# Separate budget for WebSocket analyses so they cannot take every engine slot away from the UCI ports
+analysis_sem = asyncio.Semaphore(config.get("websocket_max_analyses", 2))
+
+
+def configure_logging(base_log_dir):
+    if config["enable_server_log"]:
+        server_log_file = os.path.join(base_log_dir, "server.log")
+        try:
+            logging.basicConfig(
+                level=logging.INFO,
+                format="%(asctime)s [%(levelname)s] %(message)s",
+                handlers=[
+                    logging.FileHandler(server_log_file),
+                    logging.StreamHandler()
+                ]
+            )
+        except Exception as e:
+            print(f"Error configuring logging: {e}")
+            logging.basicConfig(
+                level=logging.INFO,
+                format="%(asctime)s [%(levelname)s] %(message)s",
+                handlers=[
+                    logging.StreamHandler()
+                ]
+            )
+            logging.error(f"Error configuring file logging: {e}")
+    else:
         logging.basicConfig(
             level=logging.INFO,
             format="%(asctime)s [%(levelname)s] %(message)s",
@@ -44,16 +78,6 @@ if config["enable_server_log"]:
                 logging.StreamHandler()
             ]
         )
-        logging.error(f"Error configuring file logging: {e}")
-else:
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[
-            logging.StreamHandler()
-        ]
-    )
-sem = asyncio.Semaphore(MAX_CONNECTIONS)
 
 
 async def watchdog_timer(interval):
@@ -118,6 +142,12 @@ def generate_subnets_to_avoid(ip_addresses_to_avoid, subnets_to_avoid):
 ]
 
 
+async def run_firewall_command(cmd):
+    loop = asyncio.get_running_loop()
+    # netsh can take seconds, run it in a thread so the event loop keeps serving clients
+    return await loop.run_in_executor(None, lambda: subprocess.run(cmd, check=False, capture_output=True, text=True))
+
+
 async def async_generate_subnets_to_avoid(ip_addresses_to_avoid, subnets_to_avoid):
     loop = asyncio.get_running_loop()
     # Run the CPU-bound function in a separate process to avoid blocking the event loop
@@ -133,44 +163,45 @@ async def block_ip_address(ip_address, ports):
         logging.warning(f"Skipping blocking of non-global IP address: {ip_address}")
         return
 
-    # Check if the IP address is already blocked
-    check_cmd = ["netsh", "advfirewall", "firewall", "show", "rule", "name=Chess-Block-IPs"]
-    process_check = subprocess.run(check_cmd, capture_output=True, text=True)
-
-    if process_check.returncode == 0:
-        # If the Chess-Block-IPs rule exists, get the existing blocked IPs
-        existing_ips = re.findall(r"RemoteIP:\s*(.*)", process_check.stdout)
-        if existing_ips:
-            existing_ips = existing_ips[0].split(",")
-            if ip_address in existing_ips:
-                logging.info(f"IP {ip_address} is already blocked by the Chess-Block-IPs rule")
-                return
-        else:
-            existing_ips = []
+    async with firewall_lock:
+        # Check if the IP address is already blocked
+        check_cmd = ["netsh", "advfirewall", "firewall", "show", "rule", "name=Chess-Block-IPs"]
+        process_check = await run_firewall_command(check_cmd)
+
+        if process_check.returncode == 0:
+            # If the Chess-Block-IPs rule exists, get the existing blocked IPs
+            existing_ips = re.findall(r"RemoteIP:\s*(.*)", process_check.stdout)
+            if existing_ips:
+                existing_ips = existing_ips[0].split(",")
+                if ip_address in existing_ips:
+                    logging.info(f"IP {ip_address} is already blocked by the Chess-Block-IPs rule")
+                    return
+            else:
+                existing_ips = []
 
-        # Add the new IP address to the existing blocked IPs
-        updated_ips = ",".join(existing_ips + [ip_address])
-        set_cmd = [
-            "netsh", "advfirewall", "firewall", "set", "rule", "name=Chess-Block-IPs",
-            "new", "remoteip=" + updated_ips
-        ]
-        process_set = subprocess.run(set_cmd, check=False, capture_output=True, text=True)
-        if process_set.returncode != 0:
-            logging.error(f"Failed to update the Chess-Block-IPs rule with IP {ip_address}: {process_set.stderr}")
-        else:
-            logging.info(f"Added IP {ip_address} to the existing Chess-Block-IPs rule")
-    else:
-        # If the Chess-Block-IPs rule doesn't exist, create a new rule
-        block_cmd = [
-            "netsh", "advfirewall", "firewall", "add", "rule", "name=Chess-Block-IPs",
-            "dir=in", "action=block", "protocol=TCP", "localport=" + ports,
-            "remoteip=" + ip_address, "enable=yes"
-        ]
-        process_block = subprocess.run(block_cmd, check=False, capture_output=True, text=True)
-        if process_block.returncode != 0:
-            logging.error(f"Failed to create block rule for IP {ip_address}: {process_block.stderr}")
+            # Add the new IP address to the existing blocked IPs
+            updated_ips = ",".join(existing_ips + [ip_address])
+            set_cmd = [
+                "netsh", "advfirewall", "firewall", "set", "rule", "name=Chess-Block-IPs",
+                "new", "remoteip=" + updated_ips
+            ]
+            process_set = await run_firewall_command(set_cmd)
+            if process_set.returncode != 0:
+                logging.error(f"Failed to update the Chess-Block-IPs rule with IP {ip_address}: {process_set.stderr}")
+            else:
+                logging.info(f"Added IP {ip_address} to the existing Chess-Block-IPs rule")
         else:
-            logging.info(f"Created new Chess-Block-IPs rule and blocked IP {ip_address}")
+            # If the Chess-Block-IPs rule doesn't exist, create a new rule
+            block_cmd = [
+                "netsh", "advfirewall", "firewall", "add", "rule", "name=Chess-Block-IPs",
+                "dir=in", "action=block", "protocol=TCP", "localport=" + ports,
+                "remoteip=" + ip_address, "enable=yes"
+            ]
+            process_block = await run_firewall_command(block_cmd)
+            if process_block.returncode != 0:
+                logging.error(f"Failed to create block rule for IP {ip_address}: {process_block.stderr}")
+            else:
+                logging.info(f"Created new Chess-Block-IPs rule and blocked IP {ip_address}")
     logging.debug(f"Exiting block_ip_address for IP {ip_address}")
         
 
@@ -180,44 +211,45 @@ async def block_subnet(subnet, ports):
         logging.warning(f"Skipping blocking of non-global subnet: {subnet}")
         return
 
-    # Check if the subnet is already blocked
-    check_cmd = ["netsh", "advfirewall", "firewall", "show", "rule", "name=Chess-Block-Other"]
-    process_check = subprocess.run(check_cmd, capture_output=True, text=True)
-
-    if process_check.returncode == 0:
-        # If the Chess-Block-Other rule exists, get the existing blocked subnets
-        existing_subnets = re.findall(r"RemoteIP:\s*(.*)", process_check.stdout)
-        if existing_subnets:
-            existing_subnets = existing_subnets[0].split(",")
-            if subnet in existing_subnets:
-                logging.info(f"Subnet {subnet} is already blocked by the Chess-Block-Other rule")
-                return
-        else:
-            existing_subnets = []
+    async with firewall_lock:
+        # Check if the subnet is already blocked
+        check_cmd = ["netsh", "advfirewall", "firewall", "show", "rule", "name=Chess-Block-Other"]
+        process_check = await run_firewall_command(check_cmd)
+
+        if process_check.returncode == 0:
+            # If the Chess-Block-Other rule exists, get the existing blocked subnets
+            existing_subnets = re.findall(r"RemoteIP:\s*(.*)", process_check.stdout)
+            if existing_subnets:
+                existing_subnets = existing_subnets[0].split(",")
+                if subnet in existing_subnets:
+                    logging.info(f"Subnet {subnet} is already blocked by the Chess-Block-Other rule")
+                    return
+            else:
+                existing_subnets = []
 
-        # Add the new subnet to the existing blocked subnets
-        updated_subnets = ",".join(existing_subnets + [subnet])
-        set_cmd = [
-            "netsh", "advfirewall", "firewall", "set", "rule", "name=Chess-Block-Other",
-            "new", "remoteip=" + updated_subnets
-        ]
-        process_set = subprocess.run(set_cmd, check=False, capture_output=True, text=True)
-        if process_set.returncode != 0:
-            logging.error(f"Failed to update the Chess-Block-Other rule with subnet {subnet}: {process_set.stderr}")
-        else:
-            logging.info(f"Added subnet {subnet} to the existing Chess-Block-Other rule")
-    else:
-        # If the Chess-Block-Other rule doesn't exist, create a new rule
-        block_cmd = [
-            "netsh", "advfirewall", "firewall", "add", "rule", "name=Chess-Block-Other",
-            "dir=in", "action=block", "protocol=TCP", "localport=" + ports,
-            "remoteip=" + subnet, "enable=yes"
-        ]
-        process_block = subprocess.run(block_cmd, check=False, capture_output=True, text=True)
-        if process_block.returncode != 0:
-            logging.error(f"Failed to create block rule for subnet {subnet}: {process_block.stderr}")
+            # Add the new subnet to the existing blocked subnets
+            updated_subnets = ",".join(existing_subnets + [subnet])
+            set_cmd = [
+                "netsh", "advfirewall", "firewall", "set", "rule", "name=Chess-Block-Other",
+                "new", "remoteip=" + updated_subnets
+            ]
+            process_set = await run_firewall_command(set_cmd)
+            if process_set.returncode != 0:
+                logging.error(f"Failed to update the Chess-Block-Other rule with subnet {subnet}: {process_set.stderr}")
+            else:
+                logging.info(f"Added subnet {subnet} to the existing Chess-Block-Other rule")
         else:
-            logging.info(f"Created new Chess-Block-Other rule and blocked subnet {subnet}")
+            # If the Chess-Block-Other rule doesn't exist, create a new rule
+            block_cmd = [
+                "netsh", "advfirewall", "firewall", "add", "rule", "name=Chess-Block-Other",
+                "dir=in", "action=block", "protocol=TCP", "localport=" + ports,
+                "remoteip=" + subnet, "enable=yes"
+            ]
+            process_block = await run_firewall_command(block_cmd)
+            if process_block.returncode != 0:
+                logging.error(f"Failed to create block rule for subnet {subnet}: {process_block.stderr}")
+            else:
+                logging.info(f"Created new Chess-Block-Other rule and blocked subnet {subnet}")
     logging.debug(f"Exiting block_subnet for subnet {subnet}")
     
     
@@ -303,77 +335,80 @@ async def configure_firewall(config):
         # Await the completion of subnet generation
         subnets_to_block = await async_generate_subnets_to_avoid(ip_addresses_to_avoid, subnets_to_avoid)
 
-        delete_cmd = ["netsh", "advfirewall", "firewall", "delete", "rule", "name=Chess-Block-Other"]
-        process_delete = subprocess.run(delete_cmd, check=False, capture_output=True, text=True)
+        # Rebuild the rule in one step, block_subnet() must not update it in between
+        async with firewall_lock:
+            delete_cmd = ["netsh", "advfirewall", "firewall", "delete", "rule", "name=Chess-Block-Other"]
+            process_delete = await run_firewall_command(delete_cmd)
 
-        if process_delete.returncode != 0:
-            stderr_output = process_delete.stderr
-            if "No rules match the specified criteria" in stderr_output:
-                logging.info("No existing Chess-Block-Other rules found. Proceeding.")
+            if process_delete.returncode != 0:
+                stderr_output = process_delete.stderr
+                if "No rules match the specified criteria" in stderr_output:
+                    logging.info("No existing Chess-Block-Other rules found. Proceeding.")
+                else:
+                    logging.error(f"Failed to delete rule: {stderr_output}")
             else:
-                logging.error(f"Failed to delete rule: {stderr_output}")
-        else:
-            logging.info("Existing Chess-Block-Other rules removed from Windows Firewall.")
+                logging.info("Existing Chess-Block-Other rules removed from Windows Firewall.")
 
-        # Combine the subnets into a comma-separated string
-        subnets_combined = ",".join(subnets_to_block)
+            # Combine the subnets into a comma-separated string
+            subnets_combined = ",".join(subnets_to_block)
 
-        # Create a single block rule for all subnets
-        block_cmd = [
-            "netsh", "advfirewall", "firewall", "add", "rule", "name=Chess-Block-Other",
-            "dir=in", "action=block", "protocol=TCP", "localport=" + ports,
-            "remoteip=" + subnets_combined, "enable=yes"
-        ]
-        process_block = subprocess.run(block_cmd, check=False, capture_output=True, text=True)
-        if process_block.returncode != 0:
-            logging.error(f"Failed to add block rule: {process_block.stderr}")
-        else:
-            logging.info(f"Blocked inbound traffic for subnets {subnets_combined} on ports {ports}.")
+            # Create a single block rule for all subnets
+            block_cmd = [
+                "netsh", "advfirewall", "firewall", "add", "rule", "name=Chess-Block-Other",
+                "dir=in", "action=block", "protocol=TCP", "localport=" + ports,
+                "remoteip=" + subnets_combined, "enable=yes"
+            ]
+            process_block = await run_firewall_command(block_cmd)
+            if process_block.returncode != 0:
+                logging.error(f"Failed to add block rule: {process_block.stderr}")
+            else:
+                logging.info(f"Blocked inbound traffic for subnets {subnets_combined} on ports {ports}.")
             
         
         
 async def unblock_trusted_ips_and_subnets():
     # Get the existing blocked IPs from the Chess-Block-IPs rule
-    check_ips_cmd = ["netsh", "advfirewall", "firewall", "show", "rule", "name=Chess-Block-IPs"]
-    process_check_ips = subprocess.run(check_ips_cmd, capture_output=True, text=True)
-
-    if process_check_ips.returncode == 0:
-        existing_ips = re.findall(r"RemoteIP:\s*(.*)", process_check_ips.stdout)
-        if existing_ips:
-            existing_ips = existing_ips[0].split(",")
-            updated_ips = [ip for ip in existing_ips if ip not in config["trusted_sources"]]
-            if len(updated_ips) < len(existing_ips):
-                updated_ips_str = ",".join(updated_ips)
-                set_ips_cmd = [
-                    "netsh", "advfirewall", "firewall", "set", "rule", "name=Chess-Block-IPs",
-                    "new", "remoteip=" + updated_ips_str
-                ]
-                process_set_ips = subprocess.run(set_ips_cmd, check=False, capture_output=True, text=True)
-                if process_set_ips.returncode != 0:
-                    logging.error(f"Failed to update the Chess-Block-IPs rule: {process_set_ips.stderr}")
-                else:
-                    logging.info("Removed trusted IP addresses from Chess-Block-IPs rule")
-
-    # Get the existing blocked subnets from the Chess-Block-Other rule
-    check_subnets_cmd = ["netsh", "advfirewall", "firewall", "show", "rule", "name=Chess-Block-Other"]
-    process_check_subnets = subprocess.run(check_subnets_cmd, capture_output=True, text=True)
-
-    if process_check_subnets.returncode == 0:
-        existing_subnets = re.findall(r"RemoteIP:\s*(.*)", process_check_subnets.stdout)
-        if existing_subnets:
-            existing_subnets = existing_subnets[0].split(",")
-            updated_subnets = [subnet for subnet in existing_subnets if not any(ipaddress.ip_network(subnet).subnet_of(ipaddress.ip_network(trusted_subnet)) for trusted_subnet in config["trusted_subnets"])]
-            if len(updated_subnets) < len(existing_subnets):
-                updated_subnets_str = ",".join(updated_subnets)
-                set_subnets_cmd = [
-                    "netsh", "advfirewall", "firewall", "set", "rule", "name=Chess-Block-Other",
-                    "new", "remoteip=" + updated_subnets_str
-                ]
-                process_set_subnets = subprocess.run(set_subnets_cmd, check=False, capture_output=True, text=True)
-                if process_set_subnets.returncode != 0:
-                    logging.error(f"Failed to update the Chess-Block-Other rule: {process_set_subnets.stderr}")
-                else:
-                    logging.info("Removed trusted subnets from Chess-Block-Other rule")
+    async with firewall_lock:
+        check_ips_cmd = ["netsh", "advfirewall", "firewall", "show", "rule", "name=Chess-Block-IPs"]
+        process_check_ips = await run_firewall_command(check_ips_cmd)
+
+        if process_check_ips.returncode == 0:
+            existing_ips = re.findall(r"RemoteIP:\s*(.*)", process_check_ips.stdout)
+            if existing_ips:
+                existing_ips = existing_ips[0].split(",")
+                updated_ips = [ip for ip in existing_ips if ip not in config["trusted_sources"]]
+                if len(updated_ips) < len(existing_ips):
+                    updated_ips_str = ",".join(updated_ips)
+                    set_ips_cmd = [
+                        "netsh", "advfirewall", "firewall", "set", "rule", "name=Chess-Block-IPs",
+                        "new", "remoteip=" + updated_ips_str
+                    ]
+                    process_set_ips = await run_firewall_command(set_ips_cmd)
+                    if process_set_ips.returncode != 0:
+                        logging.error(f"Failed to update the Chess-Block-IPs rule: {process_set_ips.stderr}")
+                    else:
+                        logging.info("Removed trusted IP addresses from Chess-Block-IPs rule")
+
+        # Get the existing blocked subnets from the Chess-Block-Other rule
+        check_subnets_cmd = ["netsh", "advfirewall", "firewall", "show", "rule", "name=Chess-Block-Other"]
+        process_check_subnets = await run_firewall_command(check_subnets_cmd)
+
+        if process_check_subnets.returncode == 0:
+            existing_subnets = re.findall(r"RemoteIP:\s*(.*)", process_check_subnets.stdout)
+            if existing_subnets:
+                existing_subnets = existing_subnets[0].split(",")
+                updated_subnets = [subnet for subnet in existing_subnets if not any(ipaddress.ip_network(subnet).subnet_of(ipaddress.ip_network(trusted_subnet)) for trusted_subnet in config["trusted_subnets"])]
+                if len(updated_subnets) < len(existing_subnets):
+                    updated_subnets_str = ",".join(updated_subnets)
+                    set_subnets_cmd = [
+                        "netsh", "advfirewall", "firewall", "set", "rule", "name=Chess-Block-Other",
+                        "new", "remoteip=" + updated_subnets_str
+                    ]
+                    process_set_subnets = await run_firewall_command(set_subnets_cmd)
+                    if process_set_subnets.returncode != 0:
+                        logging.error(f"Failed to update the Chess-Block-Other rule: {process_set_subnets.stderr}")
+                    else:
+                        logging.info("Removed trusted subnets from Chess-Block-Other rule")
                     
                     
                     
@@ -452,6 +487,8 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name):
         print(f"Connection closed for untrusted source {client_ip}")
         return
 
+    capture_session = None
+    speculation_task = None
     async with sem:
         try:
             engine_dir = os.path.dirname(engine_path)
@@ -465,19 +502,29 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name):
                 stderr=asyncio.subprocess.STDOUT,
                 cwd=engine_dir
             )
-            
+            if uci_capture:
+                capture_session = uci_capture.open_session(engine_name, client_ip)
+
             # Start heartbeat
             heartbeat_task = asyncio.create_task(heartbeat(writer, heartbeat_time))
 
-            async def process_command(command):
+            engine_options = {}  # option name (lower case) -> value, as last sent to the engine
+
+            async def process_command(command, speculative=False):
                 try:
                     engine_process.stdin.write(f"{command}\n".encode())
                     await engine_process.stdin.drain()
+                    if command.startswith("setoption name "):
+                        option_name, _, option_value = command[len("setoption name "):].partition(" value ")
+                        engine_options[option_name.strip().lower()] = option_value.strip()
+                    if capture_session is not None:
+                        uci_capture.record(capture_session, SPECULATIVE_INPUT if speculative else ENGINE_INPUT, command)
+                    source = "Speculative" if speculative else "Client"
                     if config["enable_uci_log"]:
                         with open(log_file, "a") as f:
-                            f.write(f"Client: {command}\n")
+                            f.write(f"{source}: {command}\n")
                     if config["detailed_log_verbosity"]:
-                        print(f"Client: {command}")
+                        print(f"{source}: {command}")
                 except Exception as e:
                     logging.error(f"Error processing command: {e}")
 
@@ -495,6 +542,8 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name):
                     decoded_data = data.decode().strip()
                     writer.write(data)
                     await writer.drain()
+                    if capture_session is not None:
+                        uci_capture.record(capture_session, ENGINE_OUTPUT, decoded_data)
                     if config["enable_uci_log"]:
                         with open(log_file, "a") as f:
                             f.write(f"Engine: {decoded_data}\n")
@@ -505,7 +554,142 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name):
 
             await process_uci_command()
 
+            # Speculative analysis: while the engine waits for the client, search the predicted next positions
+            speculation_enabled = config.get("enable_speculative_analysis", False)
+            speculative_bestmoves = 0  # speculative "go" commands the engine has not answered with bestmove yet
+            speculation_stopping = False
+            speculation_done = asyncio.Event()
+            speculation_done.set()
+            speculation_target = None  # cache key of the position being analyzed
+            speculation_result = None  # (depth, info line) of the deepest main line seen
+            speculative_position_sent = False  # the engine holds a speculative position instead of the client's
+            current_position = None
+            search_lines = {}  # multipv -> latest info record of the client's search
+
+            def speculation_key(position):
+                # Skill Level, MultiPV, UCI_Chess960, ... change the result, so sessions only share it with equal options
+                return (engine_name, tuple(sorted(engine_options.items())), position)
+
+            def predicted_positions(bestmove_record):
+                if current_position is None:
+                    return []
+                base = current_position if " moves" in current_position else f"{current_position} moves"
+                # Expected reply first, then the first two moves of every MultiPV line
+                lines = []
+                if bestmove_record.get("ponder"):
+                    lines.append([bestmove_record["move"], bestmove_record["ponder"]])
+                for multipv, record in sorted(search_lines.items()):
+                    if len(record.get("pv", [])) >= 2:
+                        lines.append(record["pv"][:2])
+
+                positions = []
+                for moves in lines:
+                    position = f"{base} {' '.join(moves)}"
+                    if position not in positions and speculation_key(position) not in speculation_cache:
+                        positions.append(position)
+                return positions[:config.get("speculative_max_positions", 3)]
+
+            async def speculate(positions):
+                nonlocal speculative_bestmoves, speculation_target, speculation_result, speculative_position_sent
+                movetime = config.get("speculative_movetime", 1000)
+                for position in positions:
+                    speculation_target = speculation_key(position)
+                    speculation_result = None
+                    speculative_position_sent = True
+                    await process_command(position, speculative=True)
+                    # Counted before the write so a cancellation cannot lose track of a running search
+                    speculation_done.clear()
+                    speculative_bestmoves += 1
+                    await process_command(f"go movetime {movetime}", speculative=True)
+                    await speculation_done.wait()
+
+            def start_speculation(bestmove_record):
+                nonlocal speculation_task
+                if bestmove_record["move"] in (None, "(none)", "0000"):
+                    return
+                positions = predicted_positions(bestmove_record)
+                if positions:
+                    speculation_task = asyncio.create_task(speculate(positions))
+
+            async def cancel_speculation():
+                nonlocal speculation_task, speculation_stopping
+                if speculation_task is not None:
+                    speculation_task.cancel()
+                    speculation_task = None
+                if speculative_bestmoves and not speculation_stopping:
+                    speculation_stopping = True
+                    await process_command("stop", speculative=True)
+                    try:
+                        await asyncio.wait_for(speculation_done.wait(), timeout=5)
+                    except asyncio.TimeoutError:
+                        # Engine output stays discarded until the outstanding speculative bestmoves arrived,
+                        # so the client's command can go ahead without seeing any of it
+                        logging.warning(f"Engine did not stop speculative analysis for {client_ip} within 5 seconds")
+
+            def process_speculative_line(decoded_data):
+                nonlocal speculative_bestmoves, speculation_stopping, speculation_result
+                if capture_session is not None:
+                    uci_capture.record(capture_session, SPECULATIVE_OUTPUT, decoded_data)
+                if config["enable_uci_log"]:
+                    with open(log_file, "a") as f:
+                        f.write(f"Engine (speculative): {decoded_data}\n")
+                record = parse_uci_line(decoded_data)
+                if record is None:
+                    return
+                if record["type"] == "info":
+                    if record.get("multipv", 1) == 1 and "pv" in record:
+                        speculation_result = (record["depth"], decoded_data)
+                else:
+                    speculative_bestmoves -= 1
+                    if speculative_bestmoves == 0:
+                        if speculation_result:
+                            store_speculation(speculation_target, *speculation_result, decoded_data)
+                        speculation_stopping = False
+                        speculation_done.set()
+
+            def track_client_search(decoded_data):
+                record = parse_uci_line(decoded_data)
+                if record is None:
+                    return
+                if record["type"] == "info":
+                    search_lines[record.get("multipv", 1)] = record
+                else:
+                    start_speculation(record)
+
+            async def answer_from_cache(command):
+                if not config.get("speculative_answer_from_cache", False):
+                    return False
+                # The cache only holds the main line, a MultiPV search needs the engine
+                if engine_options.get("multipv", "1") != "1":
+                    return False
+                entry = speculation_cache.get(speculation_key(current_position))
+                tokens = command.split()
+                if entry is None or "ponder" in tokens or "infinite" in tokens or "searchmoves" in tokens:
+                    return False
+                try:
+                    required_depth = int(tokens[tokens.index("depth") + 1]) if "depth" in tokens else config.get("speculative_answer_min_depth", 0)
+                except (IndexError, ValueError):
+                    return False
+                if not required_depth or entry["depth"] < required_depth:
+                    return False
+
+                logging.info(f"Answering {command} for {client_ip} from speculative analysis (depth {entry['depth']})")
+                for line in (entry["info"], entry["bestmove"]):
+                    writer.write(f"{line}\n".encode())
+                    # Not engine output: the engine never saw this "go"
+                    if capture_session is not None:
+                        uci_capture.record(capture_session, CACHE_ANSWER, line)
+                    if config["enable_uci_log"]:
+                        with open(log_file, "a") as f:
+                            f.write(f"Cache: {line}\n")
+                await writer.drain()
+                # The engine is still idle, keep speculating from the new position
+                track_client_search(entry["info"])
+                track_client_search(entry["bestmove"])
+                return True
+
             async def process_client_commands():
+                nonlocal current_position, speculative_position_sent
                 while True:
                     try:
                         data = await asyncio.wait_for(reader.readline(), timeout=60)
@@ -518,6 +702,21 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name):
                         for command in commands:
                             command = command.strip()
                             if command:
+                                if capture_session is not None:
+                                    uci_capture.record(capture_session, CLIENT_INPUT, command)
+                                if speculation_enabled:
+                                    await cancel_speculation()
+                                    if command.startswith("position"):
+                                        current_position = " ".join(command.split())
+                                        speculative_position_sent = False
+                                    elif command.startswith("go"):
+                                        search_lines.clear()
+                                        if await answer_from_cache(command):
+                                            continue
+                                        if speculative_position_sent and current_position:
+                                            # A "go" without a new "position" searches the client's last position
+                                            await process_command(current_position)
+                                            speculative_position_sent = False
                                 if command.startswith('setoption name'):
                                     parts = command.split(' ')
                                     if len(parts) >= 5 and parts[1] == 'name' and parts[3] == 'value':
@@ -555,8 +754,16 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name):
                         if not data:
                             break
                         decoded_data = data.decode().strip()
+                        if speculative_bestmoves and decoded_data.startswith(("info", "bestmove")):
+                            # Speculative output is for the cache only, never for the client
+                            process_speculative_line(decoded_data)
+                            continue
                         writer.write(data)
                         await writer.drain()
+                        if capture_session is not None:
+                            uci_capture.record(capture_session, ENGINE_OUTPUT, decoded_data)
+                        if speculation_enabled:
+                            track_client_search(decoded_data)
                         if config["enable_uci_log"]:
                             with open(log_file, "a") as f:
                                 f.write(f"Engine: {decoded_data}\n")
@@ -592,6 +799,10 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name):
         finally:
             inactivity_task.cancel()
             heartbeat_task.cancel()
+            if speculation_task is not None:
+                speculation_task.cancel()
+            if capture_session is not None:
+                uci_capture.close_session(capture_session)
             try:
                 engine_process.terminate()
                 await engine_process.wait()
@@ -610,7 +821,7 @@ async def client_handler(reader, writer, engine_path, log_file, engine_name):
 
 
 
-async def start_server(host, port, engine_path, log_file, engine_name):
+async def start_server(host, port, engine_path, log_file, engine_name, listening=None):
     retries = 5  # Set a retry limit
     while retries > 0:
         try:
@@ -620,6 +831,8 @@ async def start_server(host, port, engine_path, log_file, engine_name):
 
             addr = server.sockets[0].getsockname()
             logging.info(f"Server listening on {addr} for engine {engine_path}")
+            if listening:
+                listening.set()
 
             async with server:
                 await server.serve_forever()
@@ -636,14 +849,570 @@ async def start_server(host, port, engine_path, log_file, engine_name):
                 await asyncio.sleep(5)
             else:
                 logging.error("Maximum retries reached. Exiting...")
+                logging.error(f"Port {port} for engine {engine_name} is not available")
+                if listening:
+                    # Let the "listeners" startup phase finish and report its time
+                    listening.set()
                 break
 
 
-async def main():
+def is_trusted_client(client_ip):
+    if client_ip in config["trusted_sources"]:
+        return True
+    return any(ipaddress.ip_address(client_ip) in ipaddress.ip_network(subnet) for subnet in config["trusted_subnets"])
+
+
+def parse_uci_line(line):
+    # Turn an engine "info" or "bestmove" line into a compact record; anything else yields None
+    tokens = line.split()
+    if not tokens:
+        return None
+
+    if tokens[0] == "bestmove":
+        record = {"type": "bestmove", "move": tokens[1] if len(tokens) > 1 else None}
+        if len(tokens) > 3 and tokens[2] == "ponder":
+            record["ponder"] = tokens[3]
+        return record
+
+    if tokens[0] != "info":
+        return None
+
+    record = {"type": "info"}
+    i = 1
+    count = len(tokens)
+    while i < count:
+        token = tokens[i]
+        if token in UCI_INFO_FIELDS and i + 1 < count:
+            try:
+                record[token] = int(tokens[i + 1])
+            except ValueError:
+                pass
+            i += 2
+        elif token == "score" and i + 2 < count:
+            try:
+                record["mate" if tokens[i + 1] == "mate" else "cp"] = int(tokens[i + 2])
+            except ValueError:
+                pass
+            i += 3
+            if i < count and tokens[i] in ("lowerbound", "upperbound"):
+                record["bound"] = "lower" if tokens[i] == "lowerbound" else "upper"
+                i += 1
+        elif token == "pv":
+            record["pv"] = tokens[i + 1:]
+            break
+        elif token in ("string", "currmove", "refutation", "currline"):
+            # Not part of a principal variation update
+            return None
+        else:
+            i += 1
+
+    if "depth" not in record:
+        return None
+    return record
+
+
+def store_speculation(key, depth, info_line, bestmove_line):
+    previous = speculation_cache.pop(key, None)
+    if previous and previous["depth"] > depth:
+        speculation_cache[key] = previous
+        return
+    speculation_cache[key] = {"depth": depth, "info": info_line, "bestmove": bestmove_line}
+    # Evict the oldest entries first
+    while len(speculation_cache) > config.get("speculative_cache_size", 1000):
+        del speculation_cache[next(iter(speculation_cache))]
+
+
+def analysis_delta(record, previous):
+    delta = {key: value for key, value in record.items() if previous.get(key) != value}
+    # Fields that disappeared (e.g. "mate" replaced by "cp") are cleared on the client
+    for key in previous:
+        if key not in record:
+            delta[key] = None
+    return delta
+
+
+def is_valid_fen(fen):
+    fields = fen.split()
+    if len(fields) != 6:
+        return False
+    board, side, castling, en_passant, halfmove, fullmove = fields
+    return bool(
+        re.fullmatch(r"[pnbrqkPNBRQK1-8]+(/[pnbrqkPNBRQK1-8]+){7}", board)
+        and side in ("w", "b")
+        and re.fullmatch(r"-|[KQkqA-Ha-h]{1,4}", castling)
+        and re.fullmatch(r"-|[a-h][36]", en_passant)
+        and halfmove.isdigit() and fullmove.isdigit()
+    )
+
+
+def request_integer(request, name):
+    value = request[name]
+    # bool is a subclass of int, but {"depth": true} is not a depth
+    if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+        raise ValueError(f"Invalid {name}")
+    return value
+
+
+def analysis_position_command(request):
+    fen = request.get("fen")
+    moves = request.get("moves") or []
+    if fen is not None and (not isinstance(fen, str) or not is_valid_fen(fen)):
+        raise ValueError("Invalid FEN")
+    if not isinstance(moves, list) or not all(isinstance(move, str) and re.fullmatch(r"[a-h][1-8][a-h][1-8][qrbn]?|0000", move) for move in moves):
+        raise ValueError("Invalid move list")
+
+    command = f"position fen {' '.join(fen.split())}" if fen else "position startpos"
+    if moves:
+        command += " moves " + " ".join(moves)
+    return command
+
+
+def analysis_limits(request):
+    for limit in ("depth", "movetime", "nodes"):
+        if limit in request:
+            return f"{limit} {request_integer(request, limit)}"
+    return "infinite"
+
+
+def encode_websocket_frame(payload, opcode=0x1):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def unmask_websocket_payload(payload, mask):
+    # XOR the whole payload at once instead of byte by byte
+    length = len(payload)
+    repeated_mask = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(repeated_mask, "big")).to_bytes(length, "big")
+
+
+async def read_websocket_message(reader, send_frame):
+    message = bytearray()
+    message_opcode = None
+    while True:
+        first, second = await reader.readexactly(2)
+        fin = first & 0x80
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await reader.readexactly(8))[0]
+        if len(message) + length > WEBSOCKET_MAX_MESSAGE_SIZE:
+            raise ValueError(f"WebSocket message exceeds {WEBSOCKET_MAX_MESSAGE_SIZE} bytes")
+
+        mask = await reader.readexactly(4) if second & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask:
+            payload = unmask_websocket_payload(payload, mask)
+
+        # Control frames may arrive between the fragments of a message
+        if opcode == 0x8:
+            return opcode, payload
+        if opcode == 0x9:
+            await send_frame(payload, 0xA)
+            continue
+        if opcode == 0xA:
+            continue
+
+        if opcode != 0x0:
+            message_opcode = opcode
+        message += payload
+        if fin:
+            return message_opcode, bytes(message)
+
+
+async def websocket_handshake(reader, writer):
+    request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=10)
+    headers = {}
+    for line in request.decode("latin-1").split("\r\n")[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+    key = headers.get("sec-websocket-key")
+    if headers.get("upgrade", "").lower() != "websocket" or not key:
+        writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        return False
+
+    accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+    writer.write(
+        "HTTP/1.1 101 Switching Protocols\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode()
+    )
+    await writer.drain()
+    return True
+
+
+def broadcast_analysis(analysis, message):
+    # queue_json never waits, so a slow subscriber cannot hold up the others or the engine
+    for queue_json, subscription_id in list(analysis["subscribers"].values()):
+        queue_json({**message, "id": subscription_id})
+
+
+def flush_analysis(analysis):
+    # Only send the fields that changed since the last update of each MultiPV line
+    for multipv, record in sorted(analysis["latest"].items()):
+        delta = analysis_delta(record, analysis["sent"].get(multipv, {}))
+        if delta:
+            analysis["sent"][multipv] = record
+            broadcast_analysis(analysis, {"type": "info", **delta, "multipv": multipv})
+
+
+async def run_analysis(key, analysis):
+    engine_name, position_command, limits, multipv = key
+    engine_path = ENGINES[engine_name]["path"]
+    update_interval = config.get("websocket_update_interval", 0.25)
+    engine_process = None
+    flush_task = None
+
+    async def periodic_flush():
+        while True:
+            await asyncio.sleep(update_interval)
+            flush_analysis(analysis)
+
+    try:
+        async with analysis_sem, sem:
+            logging.info(f"Starting analysis on {engine_name}: {position_command} go {limits} (MultiPV {multipv})")
+            engine_process = await asyncio.create_subprocess_exec(
+                engine_path,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                cwd=os.path.dirname(engine_path)
+            )
+
+            async def send_command(command):
+                engine_process.stdin.write(f"{command}\n".encode())
+                await engine_process.stdin.drain()
+
+            async def wait_for_response(expected):
+                while True:
+                    data = await asyncio.wait_for(engine_process.stdout.readline(), timeout=60)
+                    if not data:
+                        raise ConnectionResetError(f"Engine {engine_name} exited during initialization")
+                    if data.decode(errors="replace").strip() == expected:
+                        return
+
+            await send_command("uci")
+            await wait_for_response("uciok")
+            options = dict(CUSTOM_VARIABLES)
+            options.update(ENGINES[engine_name].get("custom_variables", {}))
+            for option_name, option_value in options.items():
+                if option_value != "override":
+                    await send_command(f"setoption name {option_name} value {option_value}")
+            await send_command(f"setoption name MultiPV value {multipv}")
+            await send_command("isready")
+            await wait_for_response("readyok")
+            await send_command(position_command)
+            await send_command(f"go {limits}")
+
+            flush_task = asyncio.create_task(periodic_flush())
+            while True:
+                data = await engine_process.stdout.readline()
+                if not data:
+                    raise ConnectionResetError(f"Engine {engine_name} exited during analysis")
+                record = parse_uci_line(data.decode(errors="replace"))
+                if record is None:
+                    continue
+                if record["type"] == "bestmove":
+                    flush_task.cancel()
+                    flush_analysis(analysis)
+                    # Finished, so clients subscribing from now on must start a new analysis
+                    if analysis_sessions.get(key) is analysis:
+                        del analysis_sessions[key]
+                    broadcast_analysis(analysis, record)
+                    break
+                del record["type"]
+                analysis["latest"][record.get("multipv", 1)] = record
+    except Exception as e:
+        logging.error(f"Error in analysis on {engine_name}: {e}")
+        broadcast_analysis(analysis, {"type": "error", "message": str(e)})
+    finally:
+        if flush_task:
+            flush_task.cancel()
+        # Also reached when cancelled while still waiting for a free engine slot
+        if analysis_sessions.get(key) is analysis:
+            del analysis_sessions[key]
+        if engine_process and engine_process.returncode is None:
+            try:
+                engine_process.terminate()
+                await engine_process.wait()
+            except ProcessLookupError:
+                pass
+        logging.info(f"Analysis on {engine_name} finished: {position_command}")
+
+
+async def websocket_handler(reader, writer):
+    client_ip = writer.get_extra_info('peername')[0]
+    logging.info(f"WebSocket connection opened from {client_ip}")
+
+    # Same rule as the UCI ports: only trusted sources and subnets get an engine
+    if not is_trusted_client(client_ip):
+        logging.warning(f"Untrusted WebSocket connection attempt from {client_ip}")
+        if config.get("enable_trusted_sources", False):
+            check_connection_attempts(client_ip)  # Log the untrusted connection attempt
+        writer.close()
+        return
+
+    inactivity_timeout = config.get("inactivity_timeout", 900)
+    max_subscriptions = config.get("websocket_max_subscriptions", 4)
+    last_activity_time = time.time()
+    connection_id = object()
+    subscriptions = {}  # subscription id -> analysis key
+
+    async def check_inactivity():
+        while True:
+            await asyncio.sleep(60)  # Check every minute
+            if time.time() - last_activity_time > inactivity_timeout:
+                logging.warning(f"WebSocket connection to {client_ip} closed due to inactivity.")
+                writer.close()
+                return
+
+    async def send_frame(payload, opcode=0x1):
+        # Frames are written in one piece, so no lock is needed against queue_json
+        writer.write(encode_websocket_frame(payload, opcode))
+        await writer.drain()
+
+    async def send_json(message):
+        try:
+            await send_frame(json.dumps(message, separators=(",", ":")).encode())
+        except Exception as e:
+            logging.warning(f"Error sending WebSocket message to {client_ip}: {e}")
+
+    def queue_json(message):
+        nonlocal last_activity_time
+        if writer.is_closing():
+            return
+        writer.write(encode_websocket_frame(json.dumps(message, separators=(",", ":")).encode()))
+        # A client that is still receiving updates is not inactive
+        last_activity_time = time.time()
+        if writer.transport.get_write_buffer_size() > WEBSOCKET_MAX_BUFFERED:
+            logging.warning(f"WebSocket client {client_ip} does not keep up with analysis updates, disconnecting")
+            writer.transport.abort()
+
+    def active_subscriptions():
+        return [
+            subscription_id for subscription_id, key in subscriptions.items()
+            if (connection_id, subscription_id) in analysis_sessions.get(key, {}).get("subscribers", {})
+        ]
+
+    def unsubscribe(subscription_id):
+        key = subscriptions.pop(subscription_id, None)
+        analysis = analysis_sessions.get(key)
+        if analysis is None:
+            return
+        analysis["subscribers"].pop((connection_id, subscription_id), None)
+        if not analysis["subscribers"]:
+            # Nobody is watching anymore, stop the engine; a new subscriber must not join the cancelled analysis
+            del analysis_sessions[key]
+            analysis["task"].cancel()
+
+    async def subscribe(request, subscription_id):
+        engine_name = request.get("engine")
+        if engine_name not in ENGINES:
+            await send_json({"type": "error", "id": subscription_id, "message": f"Unknown engine: {engine_name}"})
+            return
+        try:
+            multipv = min(request_integer(request, "multipv"), 256) if "multipv" in request else 1
+            key = (engine_name, analysis_position_command(request), analysis_limits(request), multipv)
+        except (TypeError, ValueError) as e:
+            await send_json({"type": "error", "id": subscription_id, "message": str(e)})
+            return
+
+        unsubscribe(subscription_id)
+        # Forget subscriptions whose analysis has already finished
+        for finished_id in set(subscriptions) - set(active_subscriptions()):
+            del subscriptions[finished_id]
+        if len(subscriptions) >= max_subscriptions:
+            await send_json({"type": "error", "id": subscription_id, "message": f"At most {max_subscriptions} subscriptions per connection"})
+            return
+        subscriptions[subscription_id] = key
+        analysis = analysis_sessions.get(key)
+        if analysis is None:
+            analysis = {"subscribers": {}, "latest": {}, "sent": {}}
+            analysis_sessions[key] = analysis
+            analysis["task"] = asyncio.create_task(run_analysis(key, analysis))
+            analysis["subscribers"][(connection_id, subscription_id)] = (queue_json, subscription_id)
+        else:
+            # Join the running analysis and catch up with everything already sent to other subscribers
+            analysis["subscribers"][(connection_id, subscription_id)] = (queue_json, subscription_id)
+            lines = [{**record, "multipv": multipv} for multipv, record in sorted(analysis["sent"].items())]
+            await send_json({"type": "snapshot", "id": subscription_id, "lines": lines})
+
+    inactivity_task = asyncio.create_task(check_inactivity())
+    try:
+        if not await websocket_handshake(reader, writer):
+            return
+
+        while True:
+            opcode, payload = await read_websocket_message(reader, send_frame)
+            last_activity_time = time.time()
+            if opcode == 0x8:
+                await send_frame(payload[:2], 0x8)
+                break
+            if opcode != 0x1:
+                continue
+
+            try:
+                request = json.loads(payload)
+                if not isinstance(request, dict):
+                    raise ValueError("Expected a JSON object")
+            except ValueError as e:
+                await send_json({"type": "error", "message": f"Invalid request: {e}"})
+                continue
+
+            request_type = request.get("type")
+            subscription_id = request.get("id")
+            if not isinstance(subscription_id, (str, int, type(None))):
+                await send_json({"type": "error", "message": "Subscription id must be a string or integer"})
+            elif request_type == "subscribe":
+                await subscribe(request, subscription_id)
+            elif request_type == "unsubscribe":
+                unsubscribe(subscription_id)
+            elif request_type == "engines":
+                await send_json({"type": "engines", "engines": list(ENGINES)})
+            else:
+                await send_json({"type": "error", "id": subscription_id, "message": f"Unknown request type: {request_type}"})
+
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        logging.info(f"WebSocket client {client_ip} disconnected")
+    except asyncio.TimeoutError:
+        logging.warning(f"WebSocket handshake with {client_ip} timed out")
+    except Exception as e:
+        logging.error(f"Error in websocket_handler for client {client_ip}: {e}")
+    finally:
+        inactivity_task.cancel()
+        for subscription_id in list(subscriptions):
+            unsubscribe(subscription_id)
+        if not writer.is_closing():
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionResetError:
+                pass
+        logging.info(f"WebSocket connection closed for client {client_ip}")
+
+
+async def start_websocket_server(host, port, listening=None):
+    retries = 5  # Set a retry limit
+    while retries > 0:
+        try:
+            server = await asyncio.start_server(websocket_handler, host, port)
+
+            addr = server.sockets[0].getsockname()
+            logging.info(f"WebSocket analysis API listening on {addr}")
+            if listening:
+                listening.set()
+
+            async with server:
+                await server.serve_forever()
+            break
+
+        except asyncio.CancelledError:
+            logging.info("WebSocket server shutdown initiated")
+            break
+        except Exception as e:
+            retries -= 1
+            logging.error(f"Error starting WebSocket server: {e}")
+            if retries > 0:
+                logging.info("Retrying in 5 seconds...")
+                await asyncio.sleep(5)
+            else:
+                logging.error("Maximum retries reached. Exiting...")
+                logging.error(f"Port {port} for the WebSocket analysis API is not available")
+                if listening:
+                    listening.set()
+                break
+
+
+async def validate_engine(engine_name, engine_path):
+    if not os.path.isfile(engine_path):
+        logging.error(f"Engine {engine_name}: executable {engine_path} not found")
+        return
+    if not os.access(engine_path, os.X_OK):
+        logging.error(f"Engine {engine_name}: {engine_path} is not executable")
+        return
+    if not config.get("validate_engine_handshake", False):
+        return
+
+    # Time a full "uci" handshake to catch engines that start but never answer
+    start = time.perf_counter()
+    engine_process = None
+    try:
+        # Inside the try: a file that exists but cannot be started is reported for this engine only
+        engine_process = await asyncio.create_subprocess_exec(
+            engine_path,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            cwd=os.path.dirname(engine_path)
+        )
+        engine_process.stdin.write(b"uci\n")
+        await engine_process.stdin.drain()
+        while True:
+            data = await asyncio.wait_for(engine_process.stdout.readline(), timeout=config.get("engine_handshake_timeout", 10))
+            if not data:
+                raise ConnectionResetError("engine exited before uciok")
+            if data.decode(errors="replace").strip() == "uciok":
+                break
+        logging.info(f"Engine {engine_name} answered uci in {(time.perf_counter() - start) * 1000:.0f} ms")
+    except asyncio.TimeoutError:
+        logging.error(f"Engine {engine_name} did not answer uci within {config.get('engine_handshake_timeout', 10)} seconds")
+    except Exception as e:
+        logging.error(f"Engine {engine_name} handshake failed: {e}")
+    finally:
+        if engine_process and engine_process.returncode is None:
+            try:
+                engine_process.terminate()
+                await engine_process.wait()
+            except ProcessLookupError:
+                pass
+
+
+async def validate_engines():
+    results = await asyncio.gather(*(validate_engine(engine_name, details["path"]) for engine_name, details in ENGINES.items()), return_exceptions=True)
+    for engine_name, result in zip(ENGINES, results):
+        if isinstance(result, Exception):
+            logging.error(f"Engine {engine_name}: validation failed: {result}")
+
+
+async def reconcile_firewall():
+    # Same order as before: drop trusted entries from the existing rules, then rebuild the subnet rule
     await unblock_trusted_ips_and_subnets()
+    await configure_firewall(config)
+
+
+async def wait_for_listeners(events):
+    await asyncio.gather(*(event.wait() for event in events))
+
+
+async def timed_startup_phase(name, coroutine, startup_time):
+    phase_start = time.perf_counter()
+    try:
+        await coroutine
+    except Exception as e:
+        logging.error(f"Startup phase '{name}' failed: {e}")
+    now = time.perf_counter()
+    logging.info(f"Startup phase '{name}' took {(now - phase_start) * 1000:.0f} ms (done {(now - startup_time) * 1000:.0f} ms after launch)")
+
+
+async def main():
+    global uci_capture, BASE_LOG_DIR
+    startup_time = time.perf_counter()
     BASE_LOG_DIR = config.get("base_log_dir", "")
+    log_dir_error = None
 
-    if config["enable_server_log"] or config["enable_uci_log"]:
+    if config["enable_server_log"] or config["enable_uci_log"] or config.get("enable_uci_capture", False):
         if not BASE_LOG_DIR:
             # If base_log_dir is not set or is blank in the config, use the script's directory for logging
             BASE_LOG_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -654,57 +1423,56 @@ async def main():
             except (FileNotFoundError, PermissionError) as e:
                 # If the script doesn't have write permissions or the specified path is invalid,
                 # update BASE_LOG_DIR to the script's directory
-                logging.error(f"Error creating log directory: {e}")
-                logging.error("Updating log directory to the script's directory.")
+                log_dir_error = e
                 BASE_LOG_DIR = os.path.dirname(os.path.abspath(__file__))
 
-    if config["enable_server_log"]:
-        server_log_file = os.path.join(BASE_LOG_DIR, "server.log")
-        try:
-            logging.basicConfig(
-                level=logging.INFO,
-                format="%(asctime)s [%(levelname)s] %(message)s",
-                handlers=[
-                    logging.FileHandler(server_log_file),
-                    logging.StreamHandler()
-                ]
-            )
-        except Exception as e:
-            print(f"Error configuring logging: {e}")
-            logging.basicConfig(
-                level=logging.INFO,
-                format="%(asctime)s [%(levelname)s] %(message)s",
-                handlers=[
-                    logging.StreamHandler()
-                ]
-            )
-            logging.error(f"Error configuring file logging: {e}")
-    else:
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s [%(levelname)s] %(message)s",
-            handlers=[
-                logging.StreamHandler()
-            ]
+    configure_logging(BASE_LOG_DIR)
+    if log_dir_error:
+        logging.error(f"Error creating log directory: {log_dir_error}")
+        logging.error("Updating log directory to the script's directory.")
+
+    if config.get("enable_uci_capture", False):
+        capture_file = os.path.join(BASE_LOG_DIR, time.strftime("uci_capture_%Y%m%d_%H%M%S.ucap"))
+        uci_capture = CaptureWriter(
+            capture_file,
+            config.get("uci_capture_block_size", 65536),
+            config.get("uci_capture_flush_interval", 5)
         )
+        logging.info(f"Capturing UCI traffic to {capture_file}")
 
+    # Open all listeners at once; firewall reconciliation and engine checks run in the background
     watchdog_timer_interval = config.get("watchdog_timer_interval", 300)  # Default to 300 seconds (5 minutes) if not specified
     tasks = []
+    listening_events = []
     for engine_name, details in ENGINES.items():
         log_file = os.path.join(BASE_LOG_DIR, f"communication_log_{engine_name}.txt")
-        task = asyncio.create_task(start_server(HOST, details["port"], details["path"], log_file, engine_name))
+        listening = asyncio.Event()
+        listening_events.append(listening)
+        task = asyncio.create_task(start_server(HOST, details["port"], details["path"], log_file, engine_name, listening))
         tasks.append(task)
         logging.info(f"Started server for {engine_name} on port {details['port']}")
 
+    if config.get("enable_websocket_api", False):
+        listening = asyncio.Event()
+        listening_events.append(listening)
+        tasks.append(asyncio.create_task(start_websocket_server(HOST, config.get("websocket_port", 9990), listening)))
+
+    tasks.append(asyncio.create_task(timed_startup_phase("listeners", wait_for_listeners(listening_events), startup_time)))
+    tasks.append(asyncio.create_task(timed_startup_phase("firewall", reconcile_firewall(), startup_time)))
+    if config.get("validate_engines", True):
+        tasks.append(asyncio.create_task(timed_startup_phase("engine validation", validate_engines(), startup_time)))
+
     # Start watchdog timer
     watchdog_task = asyncio.create_task(watchdog_timer(watchdog_timer_interval))
 
     # Set up signal handlers for graceful shutdown
+    loop = asyncio.get_running_loop()
     shutdown_event = asyncio.Event()
 
     def signal_handler():
         logging.info("Shutdown signal received")
-        shutdown_event.set()
+        # Signal handlers run outside the event loop, wake it up explicitly
+        loop.call_soon_threadsafe(shutdown_event.set)
 
     signal.signal(signal.SIGINT, lambda *_: signal_handler())
     signal.signal(signal.SIGTERM, lambda *_: signal_handler())
@@ -726,6 +1494,9 @@ async def main():
     # Wait for all tasks to complete cancellation
     await asyncio.gather(*tasks, return_exceptions=True)
 
+    if uci_capture:
+        uci_capture.close()
+
     logging.info("Server shutdown completed")
 
 if __name__ == "__main__":
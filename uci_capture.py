@@ -0,0 +1,345 @@
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import struct
+import sys
+import threading
+import time
+import zlib
+
+# Capture file layout: an append-only sequence of zlib compressed blocks.
+#   block:  magic "UCB1", uncompressed size (uint32), compressed size (uint32), zlib data
+#   record: monotonic timestamp in ns (uint64), session id (uint32), engine id (uint16),
+#           kind (uint8), payload length (uint32), payload
+# A SESSION_OPEN record carries a JSON payload with the engine name, client IP and wall clock time.
+BLOCK_MAGIC = b"UCB1"
+BLOCK_HEADER = struct.Struct("<4sII")
+RECORD_HEADER = struct.Struct("<QIHBI")
+
+# Record kinds
+CLIENT_INPUT = 0   # line received from the client
+ENGINE_OUTPUT = 1  # line received from the engine and forwarded to the client
+SESSION_OPEN = 2
+SESSION_CLOSE = 3
+ENGINE_INPUT = 4   # command actually written to the engine (server handshake and rewritten setoptions included)
+SPECULATIVE_INPUT = 5   # command written to the engine for speculative analysis
+SPECULATIVE_OUTPUT = 6  # engine output of speculative analysis, not forwarded to the client
+CACHE_ANSWER = 7        # line sent to the client from the speculative cache instead of the engine
+
+# What each replay target receives and answers with: an engine sees every command the server wrote to it,
+# the server is driven by the client input and answers with forwarded engine output or cached results
+ENGINE_SIDE = ((ENGINE_INPUT, SPECULATIVE_INPUT), (ENGINE_OUTPUT, SPECULATIVE_OUTPUT))
+CLIENT_SIDE = ((CLIENT_INPUT,), (ENGINE_OUTPUT, CACHE_ANSWER))
+
+
+class CaptureWriter:
+    def __init__(self, path, block_size=65536, flush_interval=5):
+        self.path = path
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.next_session_id = 1
+        self.engine_ids = {}
+        self.session_engines = {}
+        # Compression and file I/O happen on a writer thread so recording never stalls the event loop
+        self.file = open(path, "ab")
+        self.thread = threading.Thread(target=self.write_blocks, name="uci-capture", daemon=True)
+        self.thread.start()
+
+    def open_session(self, engine_name, client_ip):
+        session_id = self.next_session_id
+        self.next_session_id += 1
+        self.session_engines[session_id] = self.engine_ids.setdefault(engine_name, len(self.engine_ids))
+        info = {"engine": engine_name, "client": client_ip, "time": time.time()}
+        self.record(session_id, SESSION_OPEN, json.dumps(info))
+        return session_id
+
+    def close_session(self, session_id):
+        self.record(session_id, SESSION_CLOSE, b"")
+        self.session_engines.pop(session_id, None)
+
+    def record(self, session_id, kind, payload):
+        engine_id = self.session_engines.get(session_id)
+        if engine_id is None:
+            # Session already closed, e.g. by close() during shutdown
+            return
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self.lock:
+            self.buffer += RECORD_HEADER.pack(time.monotonic_ns(), session_id, engine_id, kind, len(payload))
+            self.buffer += payload
+            full = len(self.buffer) >= self.block_size
+        if full:
+            self.wakeup.set()
+
+    def close(self):
+        # Close every session still open so none ends up truncated, then write the last block
+        for session_id in list(self.session_engines):
+            self.close_session(session_id)
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.file.close()
+
+    def write_blocks(self):
+        while True:
+            # Wakes up when a block is full, on close(), and at least every flush_interval seconds
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            with self.lock:
+                block = bytes(self.buffer)
+                self.buffer.clear()
+            if block:
+                compressed = zlib.compress(block)
+                self.file.write(BLOCK_HEADER.pack(BLOCK_MAGIC, len(block), len(compressed)) + compressed)
+                self.file.flush()
+            if self.closed:
+                return
+
+
+def read_capture(path):
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                return
+            magic, size, compressed_size = BLOCK_HEADER.unpack(header)
+            if magic != BLOCK_MAGIC:
+                raise ValueError(f"Corrupt capture block at offset {f.tell() - BLOCK_HEADER.size}")
+            compressed = f.read(compressed_size)
+            if len(compressed) < compressed_size:
+                # Last block was cut short (e.g. the server was killed while writing)
+                return
+
+            block = zlib.decompress(compressed)
+            offset = 0
+            while offset < size:
+                timestamp, session_id, engine_id, kind, length = RECORD_HEADER.unpack_from(block, offset)
+                offset += RECORD_HEADER.size
+                yield timestamp, session_id, engine_id, kind, block[offset:offset + length]
+                offset += length
+
+
+def load_sessions(path):
+    sessions = {}
+    for timestamp, session_id, engine_id, kind, payload in read_capture(path):
+        if kind == SESSION_OPEN:
+            sessions[session_id] = {"info": json.loads(payload), "engine_id": engine_id, "start": timestamp, "end": timestamp, "messages": []}
+            continue
+        session = sessions.get(session_id)
+        if session is None:
+            continue
+        session["end"] = timestamp
+        if kind not in (SESSION_OPEN, SESSION_CLOSE):
+            session["messages"].append((timestamp, kind, payload.decode(errors="replace")))
+    return sessions
+
+
+def search_times(timeline, side):
+    # Seconds between each "go" and the "bestmove" answering it
+    input_kinds, output_kinds = side
+    times = []
+    go_times = []
+    for timestamp, kind, line in timeline:
+        if kind in input_kinds and line.startswith("go"):
+            go_times.append(timestamp)
+        elif kind in output_kinds and line.startswith("bestmove") and go_times:
+            # Searches are answered in order, e.g. a late speculative bestmove before the client's
+            times.append(timestamp - go_times.pop(0))
+    return times
+
+
+async def replay_session(session, engine_command, server, speed, lockstep, idle_timeout, search_timeout):
+    loop = asyncio.get_running_loop()
+    engine_process = None
+    if engine_command:
+        # An engine gets exactly what the server wrote to it, the server what the client sent
+        side = ENGINE_SIDE
+        engine_process = await asyncio.create_subprocess_exec(
+            *engine_command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+        reader, writer = engine_process.stdout, engine_process.stdin
+    else:
+        side = CLIENT_SIDE
+        host, port = server.rsplit(":", 1)
+        reader, writer = await asyncio.open_connection(host, int(port))
+
+    timeline = []
+    start = loop.time()
+    last_output = start
+    search_done = asyncio.Event()
+    search_done.set()
+
+    async def receive():
+        nonlocal last_output
+        while True:
+            data = await reader.readline()
+            if not data:
+                break
+            last_output = loop.time()
+            line = data.decode(errors="replace").strip()
+            timeline.append((last_output - start, side[1][0], line))
+            if line.startswith("bestmove"):
+                search_done.set()
+
+    receive_task = asyncio.create_task(receive())
+    try:
+        for timestamp, kind, line in session["messages"]:
+            if kind not in side[0]:
+                continue
+            if speed > 0:
+                delay = (timestamp - session["start"]) / 1e9 / speed - (loop.time() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if lockstep and line.split()[0] in ("position", "go", "ucinewgame", "quit"):
+                # Never start the next search before the target finished the previous one
+                await asyncio.wait_for(search_done.wait(), timeout=search_timeout)
+            if line.startswith("go"):
+                search_done.clear()
+            writer.write(f"{line}\n".encode())
+            await writer.drain()
+            timeline.append((loop.time() - start, kind, line))
+
+        # Let the last search finish
+        while not receive_task.done() and loop.time() - last_output < idle_timeout:
+            await asyncio.sleep(0.05)
+    finally:
+        receive_task.cancel()
+        writer.close()
+        if engine_process and engine_process.returncode is None:
+            try:
+                engine_process.terminate()
+                await engine_process.wait()
+            except ProcessLookupError:
+                pass
+    return side, timeline
+
+
+async def fake_engine(session, speed):
+    loop = asyncio.get_running_loop()
+    # Speculative traffic is part of what the engine saw; client input and cache answers never reached it
+    messages = [message for message in session["messages"] if message[1] in ENGINE_SIDE[0] + ENGINE_SIDE[1]]
+    input_indexes = [i for i, (timestamp, kind, line) in enumerate(messages) if kind in ENGINE_SIDE[0]]
+
+    def emit(line):
+        sys.stdout.write(f"{line}\n")
+        sys.stdout.flush()
+
+    async def answer(index, base_time, previous):
+        received = loop.time()
+        if previous:
+            # Answers are written in order, only "stop"/"ponderhit" cut the previous one short
+            await asyncio.wait([previous])
+        for timestamp, kind, line in messages[index + 1:]:
+            if kind in ENGINE_SIDE[0]:
+                break
+            if speed > 0:
+                delay = (timestamp - base_time) / 1e9 / speed - (loop.time() - received)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            emit(line)
+
+    # Output recorded before the first command (normally none) is printed on startup
+    pending = asyncio.create_task(answer(-1, session["start"], None))
+    position = 0
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        command = line.strip()
+        if command == "quit":
+            break
+        # Answer with the output that followed the next matching recorded command; unknown commands are ignored
+        for k in range(position, len(input_indexes)):
+            index = input_indexes[k]
+            if messages[index][2] == command:
+                if command in ("stop", "ponderhit"):
+                    pending.cancel()
+                pending = asyncio.create_task(answer(index, messages[index][0], pending))
+                position = k + 1
+                break
+    pending.cancel()
+
+
+def select_session(sessions, session_id):
+    if session_id is None:
+        if len(sessions) != 1:
+            raise SystemExit(f"Capture contains {len(sessions)} sessions, select one with --session")
+        return next(iter(sessions.values()))
+    if session_id not in sessions:
+        raise SystemExit(f"Session {session_id} not found in capture")
+    return sessions[session_id]
+
+
+def format_times(times):
+    if not times:
+        return "-"
+    return f"{len(times)} searches, avg {sum(times) / len(times) * 1000:.1f} ms, max {max(times) * 1000:.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and replay UCI traffic captured by chess.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="List the sessions of a capture file")
+    list_parser.add_argument("capture")
+
+    replay_parser = subparsers.add_parser("replay", help="Replay a session against an engine or a running server")
+    replay_parser.add_argument("capture")
+    replay_parser.add_argument("--session", type=int)
+    target = replay_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--engine", help="Engine command line to start and send the recorded engine input to")
+    target.add_argument("--server", help="HOST:PORT of a running server to send the recorded client input to")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="Time scale, 2 replays twice as fast, 0 sends without delays")
+    replay_parser.add_argument("--lockstep", action="store_true", help="Wait for bestmove before sending the next position/go")
+    replay_parser.add_argument("--search-timeout", type=float, default=600.0, help="Seconds to wait for bestmove in lockstep mode")
+    replay_parser.add_argument("--idle-timeout", type=float, default=2.0, help="Seconds without output after which the replay ends")
+
+    fake_parser = subparsers.add_parser("fake-engine", help="Act as a UCI engine that answers with the recorded engine output")
+    fake_parser.add_argument("capture")
+    fake_parser.add_argument("--session", type=int)
+    fake_parser.add_argument("--speed", type=float, default=1.0)
+
+    args = parser.parse_args()
+    sessions = load_sessions(args.capture)
+
+    if args.command == "list":
+        for session_id, session in sessions.items():
+            info = session["info"]
+            counts = {kind: 0 for kind in (CLIENT_INPUT, ENGINE_INPUT, ENGINE_OUTPUT, SPECULATIVE_INPUT, SPECULATIVE_OUTPUT, CACHE_ANSWER)}
+            for message in session["messages"]:
+                counts[message[1]] += 1
+            started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info["time"]))
+            print(f"{session_id:>6}  {started}  {info['engine']:<16} {info['client']:<16} "
+                  f"{(session['end'] - session['start']) / 1e9:>9.1f} s  "
+                  f"{counts[CLIENT_INPUT]} client / {counts[ENGINE_INPUT]} engine input / {counts[ENGINE_OUTPUT]} engine output messages"
+                  + (f", {counts[SPECULATIVE_INPUT]} speculative input / {counts[SPECULATIVE_OUTPUT]} speculative output / {counts[CACHE_ANSWER]} cache answers"
+                     if counts[SPECULATIVE_INPUT] or counts[CACHE_ANSWER] else ""))
+
+    elif args.command == "replay":
+        session = select_session(sessions, args.session)
+        engine_command = shlex.split(args.engine, posix=os.name != "nt") if args.engine else None
+        side, timeline = asyncio.run(replay_session(
+            session, engine_command, args.server, args.speed, args.lockstep, args.idle_timeout, args.search_timeout))
+        recorded = [((timestamp - session["start"]) / 1e9, kind, line) for timestamp, kind, line in session["messages"]
+                    if kind in side[0] + side[1]]
+        replayed_output = sum(1 for message in timeline if message[1] in side[1])
+        print(f"Engine: {session['info']['engine']}, client: {session['info']['client']}")
+        print(f"Recorded: {recorded[-1][0] if recorded else 0:.2f} s, {len(recorded)} messages, {format_times(search_times(recorded, side))}")
+        print(f"Replayed: {timeline[-1][0] if timeline else 0:.2f} s, {len(timeline)} messages "
+              f"({replayed_output} from target), {format_times(search_times(timeline, side))}")
+
+    elif args.command == "fake-engine":
+        asyncio.run(fake_engine(select_session(sessions, args.session), args.speed))
+
+
+if __name__ == "__main__":
+    main()